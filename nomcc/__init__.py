@@ -43,6 +43,11 @@ def connect(*args, **kwargs):
     a message string.  The method is invoked at various points of the
     during the connection and can be used for debugging.
 
+    'sndbuf' and 'rcvbuf' are the socket send and receive buffer sizes
+    to request, in octets.  The default is
+    nomcc.connection.DEFAULT_SOCKET_BUFSIZE; use None to keep the
+    operating system's defaults.
+
     Returns a Session object.
 
     """
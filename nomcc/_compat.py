@@ -13,61 +13,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Compatibility support for python 2 and 3 unified source
+"""Helpers for values that may be either text or binary.
+
+This module once held Python 2/3 unified-source shims; only Python 3
+is supported now, and the remaining helpers deal with protocol values
+that may legitimately be either text or binary.
 """
 
-import sys
 
-if sys.version_info > (3,):
-    long = int
-    xrange = range
-else:
-    long = long
-    xrange = xrange
+def decode(x):
+    # The input *must* be UTF8
+    # The output will be str
+    return x.decode('utf8')
 
-if sys.version_info > (3,):
-    import io
-    StringIO = io.StringIO
-    binary_type = bytes
-    string_types = (str,)
 
-    def decode(x):
-        # The input *must* be UTF8
-        # The output will be str(unicode)
+def maybe_decode(x):
+    # The input may be UTF8 or binary.
+    # If UTF8, output str, otherwise bytes
+    if x.isascii():
+        # The common case; always valid UTF8, no exception handling
+        # needed.
+        return x.decode('ascii')
+    try:
         return x.decode('utf8')
-
-    def maybe_decode(x):
-        # The input may be UTF8 or binary.
-        # If UTF8, output str(unicode), otherwise bytes
-        try:
-            return x.decode('utf8')
-        except UnicodeDecodeError:
-            return x
-
-    def maybe_encode(x):
-        if isinstance(x, str):
-            return x.encode('utf8')
-        else:
-            return x
-else:
-    import StringIO
-    StringIO = StringIO.StringIO
-    binary_type = str
-    string_types = (basestring,)
-
-    def decode(x):
-        # The input *must* be UTF8
-        # The output will always be str(bytes), for backwards compatibility.
-        x.decode('utf8')
+    except UnicodeDecodeError:
         return x
 
-    def maybe_decode(x):
-        # The input may be UTF8 or binary.
-        # The output will always be str(bytes), for backwards compatibility.
-        return x
 
-    def maybe_encode(x):
-        if isinstance(x, unicode):
-            return x.encode('utf8')
-        else:
-            return x
+def maybe_encode(x):
+    if isinstance(x, str):
+        return x.encode('utf8')
+    else:
+        return x
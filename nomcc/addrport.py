@@ -20,6 +20,14 @@ An 'addrport' is a network address and port pair, corresponding to a
 """
 
 import socket
+import sys
+
+# Common address literals, interned so the well-known-address checks
+# below can compare by identity.
+_ANY4 = sys.intern('0.0.0.0')
+_LOOPBACK4 = sys.intern('127.0.0.1')
+_ANY6 = sys.intern('::')
+_LOOPBACK6 = sys.intern('::1')
 
 
 class Addrport(object):
@@ -30,8 +38,24 @@ class Addrport(object):
 
     The 'sockaddr' attribute of an addrport is suitable for use as an
     address in python socket operations, e.g. socket.connect().
+
+    The 'is_numeric' attribute is True if the address is known to be a
+    numeric address literal, in which case no getaddrinfo() resolution
+    is ever needed.
     """
-    pass
+
+    __slots__ = ()
+
+    is_numeric = False
+
+    def resolved_sockaddr(self):
+        """The sockaddr to use with socket operations, without any
+        name resolution.
+
+        When 'is_numeric' is true the sockaddr may be used directly,
+        bypassing getaddrinfo() entirely.
+        """
+        return self.sockaddr
 
 
 class Addrport4(Addrport):
@@ -48,17 +72,34 @@ class Addrport4(Addrport):
     If not specified, the port defaults to zero.
     """
 
+    __slots__ = ('af', 'sockaddr', 'is_numeric')
+
     def __init__(self, ap=None):
         self.af = socket.AF_INET
-        port_start = ap.find('#')
-        if port_start >= 0:
-            addr = ap[: port_start]
-            port = ap[port_start + 1:]
-        else:
-            addr = ap
-            port = '0'
-        port = int(port)
-        self.sockaddr = (addr, port)
+        self.is_numeric = False
+        (addr, sep, port) = ap.rpartition('#')
+        if not sep:
+            (addr, port) = (ap, '0')
+        try:
+            # Validate well-formed dotted-quad input up front, in C.
+            socket.inet_aton(addr)
+            self.is_numeric = True
+        except socket.error:
+            # Tolerate other forms; any problem will surface when the
+            # address is actually used.
+            pass
+        self.sockaddr = (sys.intern(addr), int(port))
+
+    @classmethod
+    def _from_parts(cls, addr, port):
+        """Build an Addrport4 from an already-parsed numeric address
+        and integer port, skipping the textual parsing entirely.
+        """
+        self = cls.__new__(cls)
+        self.af = socket.AF_INET
+        self.is_numeric = True
+        self.sockaddr = (sys.intern(addr), port)
+        return self
 
     def __str__(self):
         return "%s#%d" % (self.sockaddr[0], self.sockaddr[1])
@@ -68,8 +109,8 @@ class Addrport4(Addrport):
 
     def sending_sockaddr(self):
         """The sockaddr that should be used to send to the service."""
-        if self.sockaddr[0] == '0.0.0.0':
-            return ('127.0.0.1', self.sockaddr[1])
+        if self.sockaddr[0] is _ANY4:
+            return (_LOOPBACK4, self.sockaddr[1])
         else:
             return self.sockaddr
 
@@ -88,25 +129,26 @@ class Addrport6(Addrport):
     If not specified, the port defaults to zero.
     """
 
+    __slots__ = ('af', 'sockaddr', 'is_numeric')
+
     def __init__(self, ap=None):
         self.af = socket.AF_INET6
-        port_start = ap.find('#')
-        if port_start >= 0:
-            addrscope = ap[: port_start]
-            port = int(ap[port_start + 1:])
-        else:
-            addrscope = ap
-            port = '0'
-        scope_start = ap.find('%')
-        if scope_start >= 0:
-            addr = addrscope[: scope_start]
-            scope = addrscope[scope_start + 1:]
-        else:
-            addr = addrscope
-            scope = 0
-        port = int(port)
-        scope = int(scope)
-        self.sockaddr = (addr, port, 0, scope)
+        self.is_numeric = False
+        (addrscope, sep, port) = ap.rpartition('#')
+        if not sep:
+            (addrscope, port) = (ap, '0')
+        (addr, sep, scope) = addrscope.partition('%')
+        if not sep:
+            scope = '0'
+        try:
+            # Validate well-formed numeric input up front, in C.
+            socket.inet_pton(socket.AF_INET6, addr)
+            self.is_numeric = True
+        except socket.error:
+            # Tolerate other forms; any problem will surface when the
+            # address is actually used.
+            pass
+        self.sockaddr = (sys.intern(addr), int(port), 0, int(scope))
 
     def __str__(self):
         if self.sockaddr[3] != 0:
@@ -121,9 +163,10 @@ class Addrport6(Addrport):
     def sending_sockaddr(self):
         """The address that should be used to send to the service.
         """
-        if self.sockaddr[0] == '::':
+        if self.sockaddr[0] is _ANY6:
             return (
-                '::1', self.sockaddr[1], self.sockaddr[2], self.sockaddr[3]
+                _LOOPBACK6, self.sockaddr[1], self.sockaddr[2],
+                self.sockaddr[3]
             )
         else:
             return self.sockaddr
@@ -133,9 +176,13 @@ def new(text):
     """
     Create a new IPv4 or IPv6 Addrport object (as appropriate) based
     on the textual addrport representation 'text'.
+
+    Passing an existing Addrport object returns it unchanged.
     """
 
-    if text.find(':') >= 0:
+    if isinstance(text, Addrport):
+        return text
+    if ':' in text:
         return Addrport6(text)
     else:
         return Addrport4(text)
@@ -0,0 +1,407 @@
+# Copyright (C) 2019 Akamai Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Nominum Command Channel Sessions for asyncio.
+
+An AsyncSession is the asyncio counterpart of nomcc.session.Session:
+instead of a reader and writer thread per session, all sessions share
+the running event loop, so a single process can multiplex many
+channels cheaply.  The wire encoding and nonce protocol are shared
+with nomcc.connection; only the socket I/O differs.
+
+Typical use:
+
+    session = await nomcc.aio_session.connect('127.0.0.1#5353#secret')
+    response = await session.tell('version')
+    await session.close()
+"""
+
+import asyncio
+import collections
+import functools
+import inspect
+import sys
+
+import nomcc.closer
+import nomcc.connection
+import nomcc.exceptions
+import nomcc.message
+import nomcc.sequence
+import nomcc.wire
+
+
+class AsyncRequestState(object):
+    """An in-flight request on an AsyncSession.
+
+    The analogue of nomcc.session.RequestState, with an asyncio.Future
+    in place of the threading.Event; get_response() is a coroutine.
+    """
+    def __init__(self, request, return_data, raise_error, sequence_ok):
+        self.future = asyncio.get_event_loop().create_future()
+        self.request = request
+        self.return_data = return_data
+        self.raise_error = raise_error
+        self.sequence_ok = sequence_ok
+
+    async def get_response(self, timeout=nomcc.closer.DEFAULT_TIMEOUT):
+        """Get the response to the request.
+
+        Waits until the request completes or the specified timeout occurs.
+        """
+        try:
+            # Shield the future so a timeout doesn't cancel the
+            # request itself; like the threaded session, the response
+            # can still be collected later.
+            response = await asyncio.wait_for(asyncio.shield(self.future),
+                                              timeout)
+        except asyncio.TimeoutError:
+            raise nomcc.exceptions.Timeout
+        if not self.sequence_ok:
+            if '_seq' in response['_ctrl']:
+                raise nomcc.exceptions.UnexpectedSequence
+        _data = response['_data']
+        if self.raise_error and 'err' in _data:
+            raise nomcc.exceptions.Error(_data['err'])
+        if self.return_data:
+            return _data
+        else:
+            return response
+
+    def __call__(self, session, message):
+        """Handle 'message' by completing the future."""
+        if not self.future.done():
+            self.future.set_result(message)
+        return True
+
+    def return_exception(self, exception):
+        if not self.future.done():
+            self.future.set_exception(exception)
+            # The request may have been abandoned (e.g. its
+            # get_response already timed out), leaving no awaiter;
+            # retrieve the exception so asyncio doesn't log it as
+            # never retrieved.  A later await still raises it.
+            self.future.exception()
+
+
+class AsyncReader(object):
+    """Asynchronous iterator over a multi-response (sequence) question.
+
+    The analogue of nomcc.sequence.Reader:
+
+        async for data in session.sequence('list_queries'):
+            ...
+    """
+    def __init__(self, session, data, timeout, num, raise_error):
+        (self.request, _) = nomcc.message._normalize_request(data)
+        self.session = session
+        self.first = True
+        self.done = False
+        self._datas = collections.deque()
+        self.timeout = timeout
+        self._num = num
+        self.raise_error = raise_error
+        self._seq = None
+        self.batch = False
+        self._next_request = {'_ctrl': {}, '_data': {'type': 'next'}}
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._datas:
+            return self._datas.popleft()
+        elif self.done:
+            raise StopAsyncIteration
+        elif self.first:
+            self.first = False
+            response = await self.session.tell(self.request, self.timeout,
+                                               False, True)
+            if '_batch' in response['_ctrl'] and self._num > 0:
+                self.batch = True
+            if '_more' in response['_ctrl']:
+                try:
+                    self._seq = response['_ctrl']['_seq']
+                except KeyError:
+                    raise nomcc.exceptions.BadSequence
+            else:
+                self.done = True
+            _data = response['_data']
+            if self.done and len(_data) == 1:
+                raise StopAsyncIteration
+        else:
+            request = self._next_request
+            _ctrl = request['_ctrl']
+            _ctrl['_seq'] = self._seq
+            if self.batch:
+                _ctrl['_num'] = self._num
+            response = await self.session.tell(request, self.timeout,
+                                               False, True)
+            if '_more' not in response['_ctrl']:
+                self.done = True
+            if self.batch and 'list' in response['_data']:
+                l = response['_data']['list']
+                if not isinstance(l, list):
+                    raise nomcc.exceptions.BadSequence
+                if not l:
+                    raise StopAsyncIteration
+                self._datas = collections.deque(l)
+                _data = self._datas.popleft()
+            else:
+                _data = response['_data']
+                # A bare final response (just its 'type') carries no
+                # data; the check runs once per response, not once per
+                # batched row.
+                if self.done and len(_data) == 1:
+                    raise StopAsyncIteration
+        if self.raise_error and 'err' in _data:
+            raise nomcc.exceptions.Error(_data['err'])
+        return _data
+
+    async def close(self):
+        if self.done:
+            return
+        self.done = True
+        if self.first:
+            # Nothing was ever sent, so there is no server-side
+            # sequence to end.
+            return
+        request = {'_ctrl': {'_seq': self._seq,
+                             '_end': nomcc.message._TRUE},
+                   '_data': nomcc.sequence.Reader._NEXT_DATA}
+        await self.session.tell(request, self.timeout)
+
+
+class AsyncSession(object):
+    """A command channel session driven by an asyncio event loop.
+
+    The session reuses the nonce and wire machinery of an existing
+    (already handshaken) nomcc.connection.Connection, but performs all
+    subsequent socket I/O through asyncio streams, so no threads are
+    created per session.
+
+    Use the module-level connect() coroutine to create one.
+
+    AsyncSessions support the asynchronous context manager protocol.
+    """
+    def __init__(self, connection, dispatch=None):
+        """Initialize a session.
+
+        If 'dispatch' is not None, then it will be used to handle messages
+        that don't have an associated AsyncRequestState.  It may be a
+        plain callable or a coroutine function.
+        """
+        self.connection = connection
+        self.dispatch = dispatch
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self.closed = False
+
+    async def _start(self):
+        sock = self.connection.sock
+        sock.setblocking(False)
+        (self._reader, self._writer) = await asyncio.open_connection(
+            sock=sock)
+        self._read_task = asyncio.get_event_loop().create_task(
+            self._read_loop())
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+        return False
+
+    async def _read_loop(self):
+        connection = self.connection
+        reader = self._reader
+        readexactly = reader.readexactly
+        unpack = nomcc.connection._LEN_STRUCT.unpack
+        try:
+            while True:
+                ldata = await readexactly(4)
+                (l,) = unpack(ldata)
+                if l > nomcc.connection.MAX_WIRE_SIZE:
+                    raise nomcc.exceptions.MessageTooBig
+                wire = await readexactly(l)
+                message = nomcc.wire.from_wire(wire, connection.secret)
+                if connection.tracer is not None:
+                    connection.tracer(connection, 'read', message)
+                state = connection._check(message)
+                tag = nomcc.message.classify(message)
+                handled = False
+                # try to handle the message ...
+                try:
+                    if callable(state):
+                        handled = state(self, message)
+                    if not handled and self.dispatch is not None:
+                        handled = self.dispatch(self, message, state)
+                        if inspect.isawaitable(handled):
+                            handled = await handled
+                except (SystemExit, KeyboardInterrupt,
+                        nomcc.exceptions.Closing):
+                    # ... passing a few exceptions on ...
+                    raise
+                except Exception as e:
+                    # ... but turning most into error responses
+                    if tag == nomcc.message.REQUEST:
+                        self.write(nomcc.message.error(message, str(e)))
+                        handled = True
+                    connection.trace("async session reader",
+                                     "handling error: %s" % str(e))
+                if not handled:
+                    if tag == nomcc.message.REQUEST:
+                        self.write(nomcc.message.error(message,
+                                                       "unknown request"))
+                    # otherwise we just drop the message
+        except (EOFError, asyncio.IncompleteReadError, ConnectionError):
+            connection.trace("async session reader", "end-of-input")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            (ty, va) = sys.exc_info()[:2]
+            connection.trace("async session reader",
+                             "exiting due to exception %s: %s" %
+                             (str(ty), str(va)))
+        finally:
+            # A dead read loop ends the session, just as the threaded
+            # _reader requests a close from its finally; mark the
+            # session closed so later requests raise Closing at once
+            # instead of waiting out their timeouts.
+            if not self.closed:
+                self.closed = True
+                self._writer.close()
+                self.connection.closed = True
+            self._cancel_outstanding()
+
+    def _cancel_outstanding(self):
+        outstanding = self.connection.take_outstanding()
+        for state in outstanding.values():
+            if state is not None:
+                state.return_exception(nomcc.exceptions.Closing())
+
+    async def close(self):
+        """Close the session, cancelling any requests still in flight."""
+        if self.closed:
+            return
+        self.closed = True
+        self._read_task.cancel()
+        try:
+            await self._read_task
+        except asyncio.CancelledError:
+            pass
+        self._cancel_outstanding()
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except (OSError, ConnectionError):
+            pass
+        self.connection.closed = True
+
+    def write(self, message, state=None):
+        """Serialize 'message' into the stream writer's buffer.
+
+        Clients should NOT need to call this method directly.
+        """
+        if self.closed:
+            raise nomcc.exceptions.Closing
+        connection = self.connection
+        connection._noncify(message, state)
+        if connection.tracer is not None:
+            connection.tracer(connection, 'write', message)
+        try:
+            wire = nomcc.wire.to_wire(message, connection.secret)
+        except Exception:
+            # Give back the sequence number.
+            if connection._unnoncify(message):
+                # We only re-raise if we successfully deleted, as
+                # otherwise we're racing with close and close won.
+                raise
+            else:
+                return
+        self._writer.write(wire)
+
+    async def ask(self, request, raise_error=True, sequence_ok=False):
+        """Send a request.
+
+        Note that 'tell()' is usually the more appropriate coroutine
+        if you want to wait for the answer.
+
+        Takes the same arguments as nomcc.session.Session.ask().
+
+        Returns an AsyncRequestState object that may be used later to
+        retrieve the response.
+        """
+        (request, return_data) = nomcc.message._normalize_request(request)
+        rstate = AsyncRequestState(request, return_data, raise_error,
+                                   sequence_ok)
+        self.write(request, rstate)
+        await self._writer.drain()
+        return rstate
+
+    async def tell(self, request, timeout=nomcc.closer.DEFAULT_TIMEOUT,
+                   raise_error=True, sequence_ok=False):
+        """Send a request and wait for a response.
+
+        Takes the same arguments as nomcc.session.Session.tell().
+
+        Returns the response.
+        """
+        rstate = await self.ask(request, raise_error, sequence_ok)
+        return await rstate.get_response(timeout)
+
+    def sequence(self, data, timeout=nomcc.closer.DEFAULT_TIMEOUT,
+                 num=nomcc.sequence.DEFAULT_BATCHING,
+                 raise_error=True):
+        """Send a request for a multi-response question, returning an
+        AsyncReader which may be used with 'async for' to iterate the
+        responses.
+
+        Takes the same arguments as nomcc.session.Session.sequence().
+        """
+        return AsyncReader(self, data, timeout, num, raise_error)
+
+    def getpeername(self):
+        """Get the peername of the other half of the connection.
+
+        Returns an address tuple appropriate to the address family of the
+        connection.
+        """
+        return self.connection.getpeername()
+
+    def set_dispatch(self, dispatch):
+        """Set the dispatch function for this session.
+        """
+        self.dispatch = dispatch
+
+
+async def new(connection, dispatch=None):
+    """Create a new AsyncSession on an existing connection."""
+    return await AsyncSession(connection, dispatch)._start()
+
+
+async def connect(*args, **kwargs):
+    """Establish an asyncio command channel session with a server.
+
+    All arguments are passed directly to nomcc.connection.connect(),
+    which (including the initial nonce and encryption handshake) is run
+    in the event loop's default executor so the loop is not blocked.
+
+    Returns an AsyncSession object.
+    """
+    loop = asyncio.get_event_loop()
+    connection = await loop.run_in_executor(
+        None, functools.partial(nomcc.connection.connect, *args, **kwargs))
+    return await new(connection)
@@ -19,14 +19,17 @@ import nomcc.addrport
 
 
 class Channel(object):
+    __slots__ = ('name', 'addrport', 'secret', 'options')
+
     def __init__(self, name, addrport, secret=None, options=None):
         self.name = name
-        if isinstance(addrport, nomcc.addrport.Addrport):
-            self.addrport = addrport
-        else:
-            if addrport.isdigit():
-                addrport = '127.0.0.1#' + addrport
-            self.addrport = nomcc.addrport.new(addrport)
+        if isinstance(addrport, str) and addrport.isdigit():
+            # A bare port means localhost; build the addrport directly
+            # from its parts rather than formatting and reparsing.
+            addrport = nomcc.addrport.Addrport4._from_parts(
+                '127.0.0.1', int(addrport))
+        # new() passes existing Addrport objects through untouched.
+        self.addrport = nomcc.addrport.new(addrport)
         if secret == '*':
             # secret "*" means "no secret"
             secret = None
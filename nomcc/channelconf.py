@@ -15,74 +15,139 @@
 
 """Nominum /etc/channel.conf Utilities"""
 
-from __future__ import absolute_import
-
 import errno
+import functools
 import os
 import os.path
 import re
 import threading
+import types
 
 import nomcc.channel
 
 from nomcc.exceptions import BadChannelConf
-from nomcc._compat import *
 
 _lock = threading.Lock()
 
-def _parse_options(options_list):
+# The default search path, resolved once at import time.
+_DEFAULT_PATHS = tuple(
+    p for p in ('/etc/channel.conf',
+                os.path.expanduser('~/.nom/channel.conf'),
+                os.environ.get('NOM_CHANNEL_CONF'))
+    if p)
+
+# Parsed-file cache, keyed by path; values are (st_mtime_ns, channels).
+# This has its own lock as _lock is held while a ChannelConf (and hence
+# the cache) is being loaded.
+_parse_cache = {}
+_parse_cache_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=256)
+def _parse_options(options_fields):
     options = {}
-    for item in options_list:
-        fields = item.split('=', 1)
-        try:
-            (key, value) = fields
-        except ValueError:
+    for item in options_fields:
+        (key, sep, value) = item.partition('=')
+        if not sep:
             raise BadChannelConf('bad option: %s' % item)
         options[key] = value
-    return options
+    # Return a read-only view; the parsed options are shared between
+    # every channel with the same option fields.
+    return types.MappingProxyType(options)
+
+_quoted_pattern = re.compile(r'"((?:\\.|[^"\\])*)"'
+                             r"|'((?:\\.|[^'\\])*)'", re.S)
+_unescape_pattern = re.compile(r'\\(.)', re.S)
+
+# Per-delimiter-set compiled patterns for _split: (delimiter run, word run)
+_split_patterns = {}
+
+
+def _get_split_patterns(delim):
+    try:
+        return _split_patterns[delim]
+    except KeyError:
+        charclass = '[' + re.escape(delim) + ']'
+        patterns = (re.compile(charclass + '+'),
+                    re.compile('(?:(?!' + charclass + ').)+', re.S))
+        _split_patterns[delim] = patterns
+        return patterns
+
 
 def _split(s, delim, quoting_ok, bug_compatible=True):
-    if isinstance(s, str):
-        buf = StringIO(s)
-    else:
+    if not isinstance(s, str):
         # Hopefully, whatever they passed in has a .read()...
-        buf = s
-    read = buf.read
-    c = read(1)
-
-    if not bug_compatible:
-        while (c != '') and (c in delim):
-            c = read(1)
+        s = s.read()
+    (delim_re, word_re) = _get_split_patterns(delim)
 
     out = []
-    while c != '':
-        word = []
-        if quoting_ok and (c in '\'"'):
-            quote_char = c
-            c = read(1)
-            while (c != '') and (c != quote_char):
-                if c == '\\':
-                    c = read(1)
-                    if c == '':
-                        raise SyntaxError
-                word.append(c)
-                c = read(1)
-            if c != quote_char:
+    pos = 0
+    n = len(s)
+    m = delim_re.match(s)
+    if m:
+        pos = m.end()
+        if bug_compatible:
+            # The character-at-a-time parser emitted a single empty
+            # token for leading delimiters; preserve that.
+            out.append('')
+    while pos < n:
+        if quoting_ok and s[pos] in '\'"':
+            m = _quoted_pattern.match(s, pos)
+            if m is None:
                 raise SyntaxError
-            c = read(1)
-
-            if (not bug_compatible) and (c != '') and (c not in delim):
+            word = m.group(1)
+            if word is None:
+                word = m.group(2)
+            if '\\' in word:
+                word = _unescape_pattern.sub(r'\1', word)
+            pos = m.end()
+            if (not bug_compatible) and pos < n and (s[pos] not in delim):
                 raise SyntaxError
         else:
-            while (c != '') and (c not in delim):
-                word.append(c)
-                c = read(1)
-        out.append(''.join(word))
-        while (c != '') and (c in delim):
-            c = read(1)
+            m = word_re.match(s, pos)
+            word = m.group()
+            pos = m.end()
+        out.append(word)
+        m = delim_re.match(s, pos)
+        if m:
+            pos = m.end()
 
     return out
 
+def _parse(filename):
+    channels = {}
+    with open(filename, 'r') as f:
+        data = f.read()
+    for l in data.splitlines():
+        # Skip comments and lines beginning with whitespace (which
+        # includes blank lines).
+        if not l or l[0] == '#' or l[0].isspace():
+            continue
+        fields = _split(l.rstrip(), ' \t', True)
+        if len(fields) >= 3:
+            options = _parse_options(tuple(fields[3:]))
+            channel = nomcc.channel.new(fields[0], fields[1],
+                                        fields[2], options)
+            channels[channel.name] = channel
+        else:
+            raise BadChannelConf('too few fields')
+    return channels
+
+
+def _load(filename):
+    """Parse 'filename', reusing the cached parse if its mtime has not
+    changed since we last read it.
+    """
+    mtime = os.stat(filename).st_mtime_ns
+    with _parse_cache_lock:
+        cached = _parse_cache.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    channels = _parse(filename)
+    with _parse_cache_lock:
+        _parse_cache[filename] = (mtime, channels)
+    return channels
+
+
 class ChannelConf(dict):
     """/etc/channel.conf container
 
@@ -102,13 +167,7 @@ class ChannelConf(dict):
         super(ChannelConf, self).__init__()
 
         if filename is None:
-            paths = ['/etc/channel.conf']
-            paths.append(os.path.expanduser('~/.nom/channel.conf'))
-            env_path = os.environ.get('NOM_CHANNEL_CONF', None)
-            if env_path:
-                paths.append(env_path)
-
-            for path in paths:
+            for path in _DEFAULT_PATHS:
                 try:
                     self.update(ChannelConf(path))
                 except IOError as e:
@@ -118,20 +177,17 @@ class ChannelConf(dict):
 
             return
 
-        ignore_pattern = re.compile(r'(#.*|\s+)')
-        with open(filename, 'r') as f:
-            for l in f:
-                if ignore_pattern.match(l):
-                    pass
-                else:
-                    fields = _split(l.rstrip(), ' \t', True)
-                    if len(fields) >= 3:
-                        options = _parse_options(fields[3:])
-                        channel = nomcc.channel.new(fields[0], fields[1],
-                                                    fields[2], options)
-                        self[channel.name] = channel
-                    else:
-                        raise BadChannelConf('too few fields')
+        self.update(_load(filename))
+
+    def __missing__(self, key):
+        # Names that are really channel literals (addr#port, a bare
+        # port, or an IPv6 address) need no channel.conf entry;
+        # synthesize a channel and cache it for later lookups.
+        if '#' in key or ':' in key or key.isdigit():
+            channel = nomcc.channel.new(key, key)
+            self[key] = channel
+            return channel
+        raise KeyError(key)
 
 default_channelconf = None
 
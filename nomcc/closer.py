@@ -23,58 +23,79 @@ Additionally, callbacks to run at close time can be specified with
 at_close().
 
 To use, simply subclass and override _close().
+
+All ThreadedClosers share a single scheduler thread which keeps their
+deadlines in a heap, rather than each instance running its own timer
+thread.
 """
 
+import heapq
+import itertools
 import threading
 import time
+import weakref
 
 DEFAULT_TIMEOUT = 300
 
-
-def _closer(tcloser):
-    with tcloser._closer_lock:
-        while not tcloser._closing:
-            timeout = None
-            now = time.time()
-            if tcloser._idle_timeout is not None:
-                if now >= tcloser._idle_timeout:
-                    tcloser._closing = True
-                    continue
-                timeout = tcloser._idle_timeout
-            if tcloser._life_timeout is not None:
-                if now >= tcloser._life_timeout:
-                    tcloser._closing = True
-                    continue
-                if timeout is None:
-                    # no idle timeout, so just use the life timeout
-                    timeout = tcloser._life_timeout
-                elif tcloser._life_timeout < timeout:
-                    # sleep until the earlier timeout
-                    timeout = tcloser._life_timeout
-            tcloser._closer_timeout = timeout
-            if timeout is not None:
-                sleep = timeout - now
-                if sleep < 0:
-                    sleep = 0
-            else:
-                sleep = None
-            tcloser._wake_closer.wait(sleep)
-    tcloser._do_close()
+# The shared deadline scheduler.  _sched_heap holds
+# (deadline, serial, weakref-to-closer) entries; entries may be stale
+# (the closer's deadline may have moved or the closer may be gone), so
+# expiry is always rechecked against the closer's own state.
+#
+# Lock ordering: a closer's _closer_lock may be held while taking
+# _sched_cv, never the reverse.
+_sched_heap = []
+_sched_cv = threading.Condition()
+_sched_serial = itertools.count()
+_sched_thread = None
+
+
+def _scheduler():
+    while True:
+        with _sched_cv:
+            now = time.monotonic()
+            expired = []
+            while _sched_heap and _sched_heap[0][0] <= now:
+                expired.append(heapq.heappop(_sched_heap)[2])
+            if not expired:
+                if _sched_heap:
+                    _sched_cv.wait(_sched_heap[0][0] - now)
+                else:
+                    _sched_cv.wait()
+                continue
+        for ref in expired:
+            tcloser = ref()
+            if tcloser is not None:
+                tcloser._deadline_expired()
+
+
+def _schedule(tcloser, deadline):
+    global _sched_thread
+    with _sched_cv:
+        if _sched_thread is None:
+            _sched_thread = threading.Thread(target=_scheduler,
+                                             name="cc-closer")
+            _sched_thread.daemon = True
+            _sched_thread.start()
+        heapq.heappush(_sched_heap,
+                       (deadline, next(_sched_serial), weakref.ref(tcloser)))
+        _sched_cv.notify()
 
 
 class ThreadedCloser(object):
+    # '__weakref__' is needed so instances can go in the scheduler heap.
+    __slots__ = ('_at_close', '_closer_lock', '_closing', '_idletime',
+                 '_idle_timeout', '_life_timeout', '_deadline', 'closed',
+                 '__weakref__')
+
     def __init__(self):
         self._at_close = []
-        self._closer_lock = threading.Lock()    # covers 'closing',
-        self._closing = False                   # 'wake_closer', and timeouts
-        self._wake_closer = threading.Condition(self._closer_lock)
+        self._closer_lock = threading.Lock()    # covers 'closing'
+        self._closing = False                   # and timeouts
         self._idletime = None
         self._idle_timeout = None
         self._life_timeout = None
-        self._closer = threading.Thread(target=_closer, args=[self],
-                                        name="cc-closer")
-        self._closer_timeout = None
-        self._closer.daemon = True
+        self._deadline = None       # min of idle and life deadlines
         self.closed = threading.Event()
 
     def __enter__(self):
@@ -88,7 +109,11 @@ class ThreadedCloser(object):
     def _do_close(self):
         self._close()
         self.closed.set()
-        for callback in reversed(self._at_close):
+        # Iterate a tuple snapshot; _at_close stays a list so a late
+        # at_close() call remains the no-op it always was (too late to
+        # ever run) rather than an error.
+        callbacks = tuple(self._at_close)
+        for callback in callbacks[::-1]:
             callback(self)
 
     def at_close(self, callback):
@@ -105,7 +130,15 @@ class ThreadedCloser(object):
             if self._closing:
                 return
             self._closing = True
-            self._wake_closer.notify()
+        self._spawn_close()
+
+    def _spawn_close(self):
+        # Closes run on their own short-lived thread; neither
+        # request_close() nor the shared scheduler may block on (or be
+        # killed by) a slow _close or at_close callback.
+        closer = threading.Thread(target=self._do_close, name="cc-closer")
+        closer.daemon = True
+        closer.start()
 
     def close(self, timeout=DEFAULT_TIMEOUT):
         """Request that the object be closed and wait for it to occur."""
@@ -116,36 +149,63 @@ class ThreadedCloser(object):
         with self._closer_lock:
             return self._closing
 
-    def _maybe_wake_closer(self, timeout):
+    def _deadline_expired(self):
+        # Called by the scheduler; our heap entry's deadline has passed,
+        # but our real deadline may have moved since the entry was made.
+        with self._closer_lock:
+            if self._closing:
+                return
+            deadline = self._deadline
+            if deadline is None:
+                return
+            if deadline > time.monotonic():
+                # The deadline was extended after this entry was
+                # scheduled; schedule a fresh entry.
+                _schedule(self, deadline)
+                return
+            self._closing = True
+        self._spawn_close()
+
+    def _update_deadline(self):
         # closer lock must be held
-        if timeout is None:
-            return
-        if self._closer_timeout is None or \
-           timeout < self._closer_timeout:
-            self._wake_closer.notify()
+        deadlines = [x for x in (self._idle_timeout, self._life_timeout)
+                     if x is not None]
+        deadline = min(deadlines) if deadlines else None
+        old = self._deadline
+        self._deadline = deadline
+        if deadline is not None and (old is None or deadline < old):
+            # No scheduled entry covers the new deadline; add one.  A
+            # later deadline needs no entry, as the existing earlier
+            # one will fire and reschedule.
+            _schedule(self, deadline)
 
     def set_lifetime(self, lifetime):
         """Set the maximum lifetime before closing."""
         with self._closer_lock:
             if lifetime is not None:
-                self._life_timeout = time.time() + lifetime
+                self._life_timeout = time.monotonic() + lifetime
             else:
                 self._life_timeout = None
-            self._maybe_wake_closer(self._life_timeout)
+            self._update_deadline()
 
     def _not_idle(self):
         # closer lock must be held
         if self._idletime is not None:
-            self._idle_timeout = time.time() + self._idletime
+            self._idle_timeout = time.monotonic() + self._idletime
         else:
             self._idle_timeout = None
-        self._maybe_wake_closer(self._idle_timeout)
+        self._update_deadline()
 
     def not_idle(self):
         """Mark the object as not idle.
 
         This resets the idle time counter to start from now.
         """
+        # Called per message; skip the lock when no idle timeout is
+        # configured.  _idletime is only written under the lock, and a
+        # stale read just delays one idle-timer reset by a message.
+        if self._idletime is None:
+            return
         with self._closer_lock:
             self._not_idle()
 
@@ -160,7 +220,9 @@ class ThreadedCloser(object):
             self._not_idle()
 
     def _start_closer(self):
-        self._closer.start()
+        # Kept for subclassers; deadline scheduling is now shared and
+        # started on demand.
+        pass
 
     def _close(self):
         # subclasser implements this
@@ -18,10 +18,10 @@
 Do not use Connections directly, use a Session instead.
 """
 
+import os
 import random
 import socket
 import struct
-import threading
 import time
 
 import nomcc.channel
@@ -31,39 +31,41 @@ import nomcc.exceptions
 import nomcc.message
 import nomcc.wire
 
-from nomcc._compat import *
+from nomcc.exceptions import (BadChannelValue, BadNoncing, BadResponse,
+                              MessageTooBig, NotResponse, NotSecure,
+                              UnsupportedAddressFamily)
 
 MAX_WIRE_SIZE = 4 * 1024 * 1024
+# Default socket buffer size requested in connect(); large enough that
+# a multi-megabyte message doesn't force excessive syscalls.
+DEFAULT_SOCKET_BUFSIZE = 1 << 18
 _U63_MAX = 2 ** 63 - 1
+_LEN_STRUCT = struct.Struct('!I')
+_MISSING = object()
+# Ask the kernel to fill a whole read in one recv where supported.
+_MSG_WAITALL = getattr(socket, 'MSG_WAITALL', 0)
 
 
 def _generate_nonce():
     try:
-        randomness = file('/dev/urandom', 'rb')
-        bytes = randomness.read(8)
-        randomness.close()
-        value = 0
-        for b in bytes:
-            value *= 256
-            value += ord(b)
-        value &= _U63_MAX
+        value = int.from_bytes(os.urandom(8), 'big') & _U63_MAX
     except Exception:
-        value = int(random.random() * _U63_MAX)
+        value = random.getrandbits(63)
     return value
 
 
 def _get_nonce_field(_ctrl, field, zero_ok=False):
-    if field not in _ctrl:
-        raise nomcc.exceptions.BadNoncing('no %s in _ctrl' % field)
     try:
         value = int(_ctrl[field])
-    except Exception:
-        raise nomcc.exceptions.BadNoncing('%s not an integer' % field)
+    except KeyError:
+        raise BadNoncing('no %s in _ctrl' % field)
+    except (ValueError, TypeError):
+        raise BadNoncing('%s not an integer' % field)
     if value < 0 or value > _U63_MAX:
-        raise nomcc.exceptions.BadNoncing(
+        raise BadNoncing(
               '%s is not a 63-bit unsigned integer' % field)
     if value == 0 and not zero_ok:
-        raise nomcc.exceptions.BadNoncing('%s is zero' % field)
+        raise BadNoncing('%s is zero' % field)
 
     return value
 
@@ -88,23 +90,26 @@ class Connection(object):
             # error.  We'll simply convert the policy to unencrypted.
             encryption_policy = nomcc.encryption.UNENCRYPTED
         self.self_nonce = _generate_nonce()
+        # The nonces are fixed (or nearly so) for the whole session;
+        # cache their wire encodings rather than re-rendering them for
+        # every message in _noncify.
+        self._snon_bytes = b'%d' % self.self_nonce
         self.self_next = 1
         self.self_first = 1
         self.encryption_policy = encryption_policy
-        self.encrypted = False
-        self.compressed = False
+        self._set_flags(False, False)
         self.tracer = tracer
         if want_read:
             request = self._read()
             _ctrl = request['_ctrl']
             if '_rpl' in _ctrl:
-                raise nomcc.exceptions.BadNoncing(
+                raise BadNoncing(
                       'cannot initialize nonce state from a reply')
             if '_evt' in _ctrl:
-                raise nomcc.exceptions.BadNoncing(
+                raise BadNoncing(
                       'cannot initialize nonce state from an event')
             if _get_nonce_field(_ctrl, '_pnon', True) != 0:
-                raise nomcc.exceptions.BadNoncing(
+                raise BadNoncing(
                       '_pnon not zero in initial noncing request')
             self.peer_nonce = _get_nonce_field(_ctrl, '_snon')
             self.peer_next = _get_nonce_field(_ctrl, '_sseq') + 1
@@ -112,7 +117,9 @@ class Connection(object):
             self.peer_nonce = 0
             self.peer_next = 0
             request = None
-        self.lock = threading.Lock()  # covers "outstanding"
+        self._pnon_bytes = b'%d' % self.peer_nonce
+        # "outstanding" is mutated only with single dict operations,
+        # which are atomic under the CPython GIL; no lock is needed.
         self.outstanding = {}
         sock.settimeout(timeout)
         self._start_noncing(request)
@@ -127,54 +134,43 @@ class Connection(object):
         return False
 
     def _add_outstanding(self, seqno, state):
-        with self.lock:
-            self.outstanding[seqno] = state
+        self.outstanding[seqno] = state
 
     def _delete_outstanding(self, seqno):
-        try:
-            with self.lock:
-                state = self.outstanding[seqno]
-                del self.outstanding[seqno]
-            return (True, state)
-        except KeyError:
+        state = self.outstanding.pop(seqno, _MISSING)
+        if state is _MISSING:
             return (False, None)
+        return (True, state)
 
     def take_outstanding(self):
-        with self.lock:
-            outstanding = self.outstanding
-            self.outstanding = {}
+        (outstanding, self.outstanding) = (self.outstanding, {})
         return outstanding
 
     def _noncify(self, message, state=None):
-        try:
-            _ctrl = message['_ctrl']
-        except KeyError:
+        _ctrl = message.get('_ctrl')
+        if _ctrl is None:
             _ctrl = {}
             message['_ctrl'] = _ctrl
-        _ctrl['_snon'] = maybe_encode(str(self.self_nonce))
-        _ctrl['_sseq'] = maybe_encode(str(self.self_next))
-        _ctrl['_pnon'] = maybe_encode(str(self.peer_nonce))
+        seq = self.self_next
+        _ctrl['_snon'] = self._snon_bytes
+        _ctrl['_sseq'] = b'%d' % seq
+        _ctrl['_pnon'] = self._pnon_bytes
 
         if not ('_rpl' in _ctrl or '_evt' in _ctrl):
             # It's a request; remember its sequence number and state.
-            self._add_outstanding(self.self_next, state)
+            self._add_outstanding(seq, state)
 
-        self.self_next += 1
+        self.self_next = seq + 1
 
-        if self.encrypted:
-            _ctrl['_enc'] = b'1'
-        else:
-            _ctrl.pop('_enc', None)
-
-        if self.compressed:
-            _ctrl['_comp'] = b'1'
-        else:
-            _ctrl.pop('_comp', None)
+        for (k, v) in self._flag_items:
+            _ctrl[k] = v
+        for k in self._flag_clears:
+            _ctrl.pop(k, None)
 
     def _unnoncify(self, message):
         _ctrl = message.get('_ctrl')
         if _ctrl is not None and \
-           _ctrl['_sseq'] == maybe_encode(str(self.self_next - 1)):
+           _ctrl['_sseq'] == b'%d' % (self.self_next - 1):
             self.self_next -= 1
             # Return True if we successfully deleted it, False otherwise
             if not ('_rpl' in _ctrl or '_evt' in _ctrl):
@@ -182,49 +178,74 @@ class Connection(object):
             else:
                 return False
         else:
-            raise nomcc.exceptions.BadNoncing('out-of-sequence unnoncify')
+            raise BadNoncing('out-of-sequence unnoncify')
 
     def _check(self, message):
+        # This runs for every received message; hoist the repeated
+        # attribute chains into locals.
         _ctrl = message['_ctrl']
 
         if self.encrypted and '_enc' not in _ctrl:
-            raise nomcc.exceptions.BadNoncing(
+            raise BadNoncing(
                 'got an unencrypted message on an encrypted connection')
 
         _pnon = _get_nonce_field(_ctrl, '_pnon')
-        if _pnon != self.self_nonce:
-            raise nomcc.exceptions.BadNoncing(
+        self_nonce = self.self_nonce
+        if _pnon != self_nonce:
+            raise BadNoncing(
                 '_pnon does not match (%s != %s)' %
-                (str(_pnon), str(self.self_nonce)))
+                (str(_pnon), str(self_nonce)))
 
         _snon = _get_nonce_field(_ctrl, '_snon')
-        if self.peer_nonce == 0:
+        peer_nonce = self.peer_nonce
+        if peer_nonce == 0:
             self.peer_nonce = _snon
-        elif _snon != self.peer_nonce:
-            raise nomcc.exceptions.BadNoncing(
+            self._pnon_bytes = b'%d' % _snon
+        elif _snon != peer_nonce:
+            raise BadNoncing(
                 '_snon does not match (%s != %s)' %
-                (str(_snon), str(self.peer_nonce)))
+                (str(_snon), str(peer_nonce)))
 
         _sseq = _get_nonce_field(_ctrl, '_sseq')
-        if self.peer_next == 0:
-            self.peer_next = _sseq
-        elif _sseq != self.peer_next:
-            raise nomcc.exceptions.BadNoncing(
+        peer_next = self.peer_next
+        if peer_next == 0:
+            self.peer_next = _sseq + 1
+        elif _sseq != peer_next:
+            raise BadNoncing(
                 '_sseq does not match (%s != %s)' %
-                (str(_sseq), str(self.peer_next)))
-
-        self.peer_next += 1
+                (str(_sseq), str(peer_next)))
+        else:
+            self.peer_next = peer_next + 1
 
         if '_rpl' in _ctrl:
             _rseq = int(_ctrl['_rseq'])
             (found, state) = self._delete_outstanding(_rseq)
             if not found:
-                raise nomcc.exceptions.BadNoncing(
+                raise BadNoncing(
                     '_rseq %s is not outstanding' % str(_rseq))
             return state
         else:
             return None
 
+    def _set_flags(self, encrypted, compressed):
+        # The encryption flags settle once the handshake is done and
+        # never change again, so precompute what _noncify must set on
+        # (and defensively clear from) every outbound _ctrl.
+        self.encrypted = encrypted
+        self.compressed = compressed
+        items = []
+        clears = []
+        if encrypted:
+            items.append(('_enc', b'1'))
+        else:
+            clears.append('_enc')
+        if compressed:
+            items.append(('_comp', b'1'))
+        else:
+            clears.append('_comp')
+        self._flag_items = tuple(items)
+        self._flag_clears = tuple(clears)
+
     def _start_noncing(self, request):
         encrypted = False
         compressed = False
@@ -244,7 +265,7 @@ class Connection(object):
                     message['_ctrl']['_encalg'] = b'aes256'
                     encrypted = True
                 elif self.encryption_policy == nomcc.encryption.REQUIRED:
-                    raise nomcc.exceptions.NotSecure(
+                    raise NotSecure(
                         'encryption is required but not available')
         self.write(message, request)
         if request is None:
@@ -252,7 +273,7 @@ class Connection(object):
             _encalg = response['_ctrl'].get('_encalg')
             if _encalg is not None:
                 if self.encryption_policy == nomcc.encryption.UNENCRYPTED:
-                    raise nomcc.exceptions.BadNoncing(
+                    raise BadNoncing(
                         'encryption not requested but peer specified _encalg')
                 elif _encalg == b'aes256z':
                     encrypted = True
@@ -260,13 +281,12 @@ class Connection(object):
                 elif _encalg == b'aes256':
                     encrypted = True
                 else:
-                    raise nomcc.exceptions.BadNoncing(
+                    raise BadNoncing(
                         'peer specified an invalid _encalg')
             elif self.encryption_policy == nomcc.encryption.REQUIRED:
-                raise nomcc.exceptions.NotSecure(
+                raise NotSecure(
                     'encryption is required but not available')
-        self.encrypted = encrypted
-        self.compressed = compressed
+        self._set_flags(encrypted, compressed)
 
     def close(self):
         if not self.closed:
@@ -280,14 +300,22 @@ class Connection(object):
         """Read the specified number of bytes from sock.  Keep trying until we
         either get the desired amount, or we hit EOF.
         """
-        s = b''
-        while count > 0:
-            n = self.sock.recv(count)
-            if n == b'':
+        buf = bytearray(count)
+        view = memoryview(buf)
+        off = 0
+        if _MSG_WAITALL:
+            # One syscall for the whole message in the common case; a
+            # short return (signal, timeout mode) finishes in the loop.
+            n = self.sock.recv_into(view, count, _MSG_WAITALL)
+            if n == 0:
+                raise EOFError
+            off = n
+        while off < count:
+            n = self.sock.recv_into(view[off:])
+            if n == 0:
                 raise EOFError
-            count = count - len(n)
-            s = s + n
-        return s
+            off += n
+        return bytes(buf)
 
     def trace(self, obj, message):
         if self.tracer is not None:
@@ -295,12 +323,13 @@ class Connection(object):
 
     def _read(self):
         ldata = self._read_all(4)
-        (l,) = struct.unpack("!I", ldata)
+        (l,) = _LEN_STRUCT.unpack(ldata)
         if l > MAX_WIRE_SIZE:
-            raise nomcc.exceptions.MessageTooBig
+            raise MessageTooBig
         wire = self._read_all(l)
         message = nomcc.wire.from_wire(wire, self.secret)
-        self.trace('read', message)
+        if self.tracer is not None:
+            self.tracer(self, 'read', message)
         return message
 
     def read(self):
@@ -314,16 +343,23 @@ class Connection(object):
         (response, state) = self.read()
         _ctrl = response['_ctrl']
         if '_rpl' not in _ctrl:
-            raise nomcc.exceptions.NotResponse
+            raise NotResponse
         if _ctrl['_rseq'] != request['_ctrl']['_sseq']:
-            raise nomcc.exceptions.BadResponse
+            raise BadResponse
         return response
 
-    def write(self, message, state=None):
+    def render(self, message, state=None):
+        """Assign nonce state to 'message' and serialize it to wire
+        format without sending it.
+
+        Returns the wire bytes, or None when serialization raced a
+        close.
+        """
         self._noncify(message, state)
-        self.trace('write', message)
+        if self.tracer is not None:
+            self.tracer(self, 'write', message)
         try:
-            wire = nomcc.wire.to_wire(message, self.secret)
+            return nomcc.wire.to_wire(message, self.secret)
         except Exception:
             # Give back the sequence number.
             if self._unnoncify(message):
@@ -331,8 +367,35 @@ class Connection(object):
                 # we're racing with close and close won.
                 raise
             else:
-                return
-        self.sock.sendall(wire)
+                return None
+
+    def write(self, message, state=None):
+        wire = self.render(message, state)
+        if wire is not None:
+            self.sock.sendall(wire)
+
+    def write_rendered(self, buffers):
+        """Send a list of render()ed messages, coalescing them into as
+        few syscalls as possible.
+        """
+        sock = self.sock
+        if len(buffers) == 1:
+            sock.sendall(buffers[0])
+            return
+        sendmsg = getattr(sock, 'sendmsg', None)
+        if sendmsg is None:
+            sock.sendall(b''.join(buffers))
+            return
+        # Scatter-gather: one sendmsg for the whole batch, with the
+        # usual partial-send loop.
+        views = [memoryview(b) for b in buffers]
+        while views:
+            n = sendmsg(views)
+            while views and n >= len(views[0]):
+                n -= len(views[0])
+                del views[0]
+            if n:
+                views[0] = views[0][n:]
 
     def getpeername(self):
         return self.sock.getpeername()
@@ -345,29 +408,23 @@ def new(*args, **kwargs):
 def channelify(where):
     if isinstance(where, nomcc.channel.Channel):
         channel = where
-    elif isinstance(where, string_types):
-        if where.find('#') >= 0:
-            parts = where.split('#')
-            address = parts[0]
-            if len(parts) > 1:
-                port = parts[1]
-            else:
-                port = 0
-            if len(parts) > 2:
-                secret = parts[2]
-            else:
-                secret = None
-            channel = nomcc.channel.new('<literal>', address + '#' + port,
-                                        secret)
+    elif isinstance(where, str):
+        (address, sep, rest) = where.partition('#')
+        if sep:
+            (port, sep, secret) = rest.partition('#')
+            channel = nomcc.channel.new('<literal>',
+                                        address + '#' + (port or '0'),
+                                        secret if sep else None)
         else:
             channel = nomcc.channelconf.find(where)
     else:
-        raise nomcc.exceptions.BadChannelValue(where)
+        raise BadChannelValue(where)
     return channel
 
 
 def connect(where, timeout=None, encryption_policy=nomcc.encryption.DESIRED,
-            source=None, tracer=None):
+            source=None, tracer=None, sndbuf=DEFAULT_SOCKET_BUFSIZE,
+            rcvbuf=DEFAULT_SOCKET_BUFSIZE):
     """Create a command channel connection.
 
     Applications should not call this method directly; they should create
@@ -393,6 +450,10 @@ def connect(where, timeout=None, encryption_policy=nomcc.encryption.DESIRED,
     a message string.  The method is invoked at various points of the
     during the connection and can be used for debugging.
 
+    'sndbuf' and 'rcvbuf' are the socket send and receive buffer sizes
+    to request, in octets.  The default is DEFAULT_SOCKET_BUFSIZE; use
+    None to keep the operating system's defaults.
+
     Returns the connection.
 
     """
@@ -401,6 +462,14 @@ def connect(where, timeout=None, encryption_policy=nomcc.encryption.DESIRED,
         encryption_policy = nomcc.encryption.REQUIRED
     sock = socket.socket(channel.addrport.af)
     sock.settimeout(timeout)
+    for (opt, size) in ((socket.SO_SNDBUF, sndbuf),
+                        (socket.SO_RCVBUF, rcvbuf)):
+        if size:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, opt, size)
+            except socket.error:
+                # The kernel may reject the size; its default is fine.
+                pass
     if source is not None:
         if isinstance(source, str):
             # source is just an address, not a sockaddr; make a
@@ -410,10 +479,13 @@ def connect(where, timeout=None, encryption_policy=nomcc.encryption.DESIRED,
             elif channel.addrport.af == socket.AF_INET6:
                 source = (source, 0, 0, 0)
             else:
-                raise nomcc.exceptions.UnsupportedAddressFamily
+                raise UnsupportedAddressFamily
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind(source)
     sock.connect(channel.addrport.sending_sockaddr())
+    # The command channel is request/response; don't let Nagle delay
+    # small writes waiting for an ACK.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     sock.settimeout(None)
     return Connection(sock, channel.secret, None, encryption_policy, tracer,
                       timeout)
@@ -0,0 +1,158 @@
+# Copyright (C) 2019 Akamai Technologies, Inc.
+# Copyright (C) 2011-2017 Nominum, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Nominum Command Channel message dispatching"""
+
+import nomcc.message
+
+
+class Dispatcher(object):
+    """Route session messages to registered handlers.
+
+    A Dispatcher is intended to be used as the 'dispatch' callable of
+    a Session:
+
+        dispatcher = nomcc.dispatcher.new()
+        dispatcher.add_mapped_handler(on_version, 'request', 'version')
+        session = nomcc.session.new(connection, dispatch=dispatcher)
+
+    A handler is a callable taking (session, message, state) and
+    returning a true value if it handled the message.
+
+    Handlers registered with add_mapped_handler() only see messages of
+    the given kind (one of nomcc.message.kinds) and _data type, and are
+    consulted first.  Generic handlers added with add_handler() or
+    prepend_handler() see every message the mapped handlers did not
+    handle.  Fallbacks set with set_fallback() run last.
+
+    If a request's type is of the 'class.command' form and the class
+    has mapped handlers but the command does not, the dispatcher
+    replies with an 'unknown command' error rather than leaving the
+    request to the session's generic unknown-request handling.
+    """
+
+    def __init__(self):
+        self._handlers = []
+        # The handlers list frozen as a tuple, rebuilt on mutation, so
+        # dispatch iterates an immutable snapshot.
+        self._handlers_tuple = ()
+        # (kind, _data type) -> handler, or a tuple of handlers when
+        # more than one is registered for the same key
+        self._handler_map = {}
+        # kind -> fallback handler
+        self._fallback_by_kind = {}
+        self._fallback = None
+        # command classes ('dns' in 'dns.flush') seen at registration
+        self._classes = set()
+
+    def add_handler(self, handler):
+        """Add a generic handler, tried after existing generic
+        handlers."""
+        self._handlers.append(handler)
+        self._handlers_tuple = tuple(self._handlers)
+
+    def prepend_handler(self, handler):
+        """Add a generic handler, tried before existing generic
+        handlers."""
+        self._handlers.insert(0, handler)
+        self._handlers_tuple = tuple(self._handlers)
+
+    def add_mapped_handler(self, handler, kind, mtype):
+        """Register 'handler' for messages of the given kind and _data
+        type."""
+        if kind not in nomcc.message.kinds:
+            raise ValueError('unknown message kind: %s' % kind)
+        key = (kind, mtype)
+        slot = self._handler_map.get(key)
+        if slot is None:
+            # The common case: keep the lone handler unwrapped.
+            self._handler_map[key] = handler
+        elif isinstance(slot, tuple):
+            self._handler_map[key] = slot + (handler,)
+        else:
+            self._handler_map[key] = (slot, handler)
+        self._maybe_remember_class(mtype)
+
+    def set_fallback(self, handler, kind=None):
+        """Set the handler of last resort, either for one message kind
+        or (with no kind) for any message."""
+        if kind is None:
+            self._fallback = handler
+        else:
+            if kind not in nomcc.message.kinds:
+                raise ValueError('unknown message kind: %s' % kind)
+            self._fallback_by_kind[kind] = handler
+
+    def _maybe_remember_class(self, mtype):
+        (cls, dot, _) = mtype.partition('.')
+        if dot:
+            self._classes.add(cls)
+
+    def __call__(self, session, message, state):
+        # Hoist the per-message attribute loads to locals; __call__
+        # runs once per received message.
+        handler_map = self._handler_map
+        handlers = self._handlers_tuple
+        fallback_by_kind = self._fallback_by_kind
+        classes = self._classes
+
+        _data = message['_data']
+        mtype = _data.get('type')
+        # nomcc.message.kind(), inlined; decoded _ctrl keys are str.
+        _ctrl = message['_ctrl']
+        if '_rpl' in _ctrl:
+            kind = 'response'
+        elif '_evt' in _ctrl:
+            kind = 'event'
+        else:
+            kind = 'request'
+
+        if mtype is not None:
+            mapped = handler_map.get((kind, mtype))
+            if mapped is None:
+                pass
+            elif isinstance(mapped, tuple):
+                for handler in mapped:
+                    if handler(session, message, state):
+                        return True
+            elif mapped(session, message, state):
+                # The common case: the slot is the lone handler itself.
+                return True
+
+        for handler in handlers:
+            if handler(session, message, state):
+                return True
+
+        fallback = fallback_by_kind.get(kind)
+        if fallback is None:
+            fallback = self._fallback
+        if fallback is not None and fallback(session, message, state):
+            return True
+
+        # Only unhandled requests are candidates for the unknown-command
+        # reply, and the type split is skipped outright when no command
+        # classes were ever registered.
+        if classes and mtype and kind == 'request':
+            (cls, dot, _) = mtype.partition('.')
+            if dot and cls in classes:
+                session.write(nomcc.message.error(message,
+                                                  'unknown command'))
+                return True
+
+        return False
+
+
+def new(*args, **kwargs):
+    return Dispatcher(*args, **kwargs)
@@ -21,14 +21,21 @@ class CCException(Exception):
     _always_use_default_msg = True
 
     def __str__(self):
-        s = super(CCException, self).__str__()
-        if s:
-            if self._always_use_default_msg:
-                return self._default_msg + ': ' + s
-            else:
-                return s
+        # Avoid the MRO walk via super() and the empty-string build in
+        # the common no-args case; exceptions here sit on hot check
+        # paths.
+        args = self.args
+        if not args:
+            return self._default_msg
+        if len(args) == 1:
+            s = str(args[0])
         else:
+            s = Exception.__str__(self)
+        if not s:
             return self._default_msg
+        if self._always_use_default_msg:
+            return self._default_msg + ': ' + s
+        return s
 
 
 class MessageTooBig(CCException):
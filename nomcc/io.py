@@ -35,20 +35,25 @@
 import errno
 import select
 import socket
+import threading
 import time
 
 import nomcc.exceptions
-from nomcc._compat import *
 
 
 def get_expiration(timeout):
+    """Convert 'timeout' seconds into a deadline on the
+    time.monotonic() clock (or None for no deadline)."""
     if timeout is None:
         return None
     else:
-        return time.time() + timeout
+        return time.monotonic() + timeout
 
 
-def _poll_for(fd, readable, writable, error, timeout):
+_epoll_tls = threading.local()
+
+
+def _epoll_for(fd, readable, writable, error, timeout):
     """
     @param fd: File descriptor (int).
     @param readable: Whether to wait for readability (bool).
@@ -56,27 +61,61 @@ def _poll_for(fd, readable, writable, error, timeout):
     @param expiration: Deadline timeout (expiration time, in seconds (float)).
 
     @return True on success, False on timeout
+
+    A session thread waits on the same descriptor for the life of its
+    connection, so we keep one epoll object per thread with the
+    descriptor registered across calls, instead of creating and
+    destroying a poll object (and its kernel state) on every wait.
     """
     event_mask = 0
     if readable:
-        event_mask |= select.POLLIN
+        event_mask |= select.EPOLLIN
     if writable:
-        event_mask |= select.POLLOUT
+        event_mask |= select.EPOLLOUT
     if error:
-        event_mask |= select.POLLERR
-
-    pollable = select.poll()
-    pollable.register(fd, event_mask)
+        event_mask |= select.EPOLLERR
+
+    # The wait helpers pass socket objects.  Take the descriptor number
+    # now: caching the object would make the later unregister call
+    # fileno() on a possibly-closed socket, whose -1 is a ValueError.
+    if not isinstance(fd, int):
+        fd = fd.fileno()
+
+    tls = _epoll_tls
+    epoll = getattr(tls, 'epoll', None)
+    if epoll is None:
+        epoll = select.epoll(sizehint=1)
+        tls.epoll = epoll
+        tls.registered_fd = -1
+    if tls.registered_fd != fd and tls.registered_fd != -1:
+        # Waiting on a different descriptor; drop the old registration
+        # so its events can't satisfy this wait.
+        try:
+            epoll.unregister(tls.registered_fd)
+        except OSError:
+            # The old descriptor is likely already closed, which
+            # removed it from the epoll set for us.
+            pass
+    # Closing a descriptor silently removes it from the interest set,
+    # and the kernel may recycle its number for a new socket, so a
+    # matching cached fd number does not prove a live registration.
+    # modify() is one syscall in the steady state and tells us when the
+    # descriptor needs (re)registering.
+    try:
+        epoll.modify(fd, event_mask)
+    except FileNotFoundError:
+        epoll.register(fd, event_mask)
+    tls.registered_fd = fd
 
     if timeout:
-        event_list = pollable.poll(long(timeout * 1000))
+        event_list = epoll.poll(timeout, maxevents=1)
     else:
-        event_list = pollable.poll()
+        event_list = epoll.poll(maxevents=1)
 
     return bool(event_list)
 
 
-def _select_for(fd, readable, writable, error, timeout):
+def _poll_for(fd, readable, writable, error, timeout):
     """
     @param fd: File descriptor (int).
     @param readable: Whether to wait for readability (bool).
@@ -85,21 +124,23 @@ def _select_for(fd, readable, writable, error, timeout):
 
     @return True on success, False on timeout
     """
-    rset, wset, xset = [], [], []
-
+    event_mask = 0
     if readable:
-        rset = [fd]
+        event_mask |= select.POLLIN
     if writable:
-        wset = [fd]
+        event_mask |= select.POLLOUT
     if error:
-        xset = [fd]
+        event_mask |= select.POLLERR
 
-    if timeout is None:
-        (rcount, wcount, xcount) = select.select(rset, wset, xset)
+    pollable = select.poll()
+    pollable.register(fd, event_mask)
+
+    if timeout:
+        event_list = pollable.poll(int(timeout * 1000))
     else:
-        (rcount, wcount, xcount) = select.select(rset, wset, xset, timeout)
+        event_list = pollable.poll()
 
-    return bool((rcount or wcount or xcount))
+    return bool(event_list)
 
 
 def _wait_for(fd, readable, writable, error, expiration):
@@ -108,7 +149,7 @@ def _wait_for(fd, readable, writable, error, expiration):
         if expiration is None:
             timeout = None
         else:
-            timeout = expiration - time.time()
+            timeout = expiration - time.monotonic()
             if timeout <= 0.0:
                 raise nomcc.exceptions.Timeout
         try:
@@ -129,13 +170,14 @@ def _set_polling_backend(fn):
     _polling_backend = fn
 
 
-if hasattr(select, 'poll'):
-    # Prefer poll() on platforms that support it because it has no
-    # limits on the maximum value of a file descriptor (plus it will
-    # be more efficient for high values).
-    _polling_backend = _poll_for
+if hasattr(select, 'epoll'):
+    # Prefer epoll() where available; the cached per-thread epoll
+    # object avoids rebuilding kernel poll state on every wait.
+    _polling_backend = _epoll_for
 else:
-    _polling_backend = _select_for
+    # All currently supported platforms have poll(), which unlike
+    # select() has no FD_SETSIZE limit on descriptor values.
+    _polling_backend = _poll_for
 
 
 def wait_for_readable(s, expiration):
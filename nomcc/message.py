@@ -14,22 +14,26 @@
 # limitations under the License.
 
 
+# The wire encoding of a set boolean flag, shared by every message
+# rather than materializing a new one-byte bytes object per flag.
+_TRUE = b'1'
+
+
 def reply_to(request, request_type=None):
-    _ctrl = {}
-    _data = {}
-    response = {'_ctrl': _ctrl, '_data': _data}
-    if request_type is not None:
-        t = request_type
-    else:
-        t = request['_data'].get('type')
-    if t is not None:
-        _data['type'] = t
-    _ctrl['_rpl'] = b'1'
-    _ctrl['_rseq'] = request['_ctrl']['_sseq']
-    s = request['_ctrl'].get('_seq')
+    # Build the sections with dict displays rather than item-by-item
+    # stores; replies are made once per handled request.
+    rctrl = request['_ctrl']
+    _ctrl = {'_rpl': _TRUE, '_rseq': rctrl['_sseq']}
+    s = rctrl.get('_seq')
     if s is not None:
         _ctrl['_seq'] = s
-    return response
+    if request_type is None:
+        request_type = request['_data'].get('type')
+    if request_type is not None:
+        _data = {'type': request_type}
+    else:
+        _data = {}
+    return {'_ctrl': _ctrl, '_data': _data}
 
 
 def error(request, detail, request_type=None):
@@ -39,15 +43,34 @@ def error(request, detail, request_type=None):
 
 
 def request(content):
-    message = {'_ctrl': {},
-               '_data': content}
-    return message
+    return {'_ctrl': {}, '_data': content}
 
 
 def event(content):
-    message = {'_ctrl': {'_evt': b'1'},
-               '_data': content}
-    return message
+    return {'_ctrl': {'_evt': _TRUE}, '_data': content}
+
+
+# classify() tags, usable as indexes into kind_names.
+REQUEST = 0
+EVENT = 1
+RESPONSE = 2
+
+# Indexed by (_rpl present) * 2 + (_evt present); _rpl wins if both
+# flags are (erroneously) set.
+_classify_tags = (REQUEST, EVENT, RESPONSE, RESPONSE)
+
+
+def classify(message):
+    """Classify 'message', returning REQUEST, RESPONSE, or EVENT.
+
+    Callers that need the kind more than once per message should
+    classify once and compare the tag, rather than calling the
+    is_*() predicates repeatedly.
+    """
+    # Two containment tests feeding a table lookup; no branches to
+    # mispredict on this per-message path.
+    _ctrl = message['_ctrl']
+    return _classify_tags[(('_rpl' in _ctrl) << 1) | ('_evt' in _ctrl)]
 
 
 def is_reply(message):
@@ -63,14 +86,28 @@ def is_request(message):
     return not ('_rpl' in _ctrl or '_evt' in _ctrl)
 
 
+kind_names = ('request', 'event', 'response')
+
+
 def kind(message):
-    _ctrl = message['_ctrl']
-    if '_rpl' in _ctrl:
-        return 'response'
-    elif '_evt' in _ctrl:
-        return 'event'
-    else:
-        return 'request'
+    return kind_names[classify(message)]
+
+
+def _normalize_request(request):
+    """Coerce 'request' (a type string, a _data section, or a full
+    message) into a message.
+
+    Returns (message, return_data): 'return_data' is True when the
+    caller passed less than a full message and so should be given just
+    the _data section of the response.
+    """
+    # An exact type test; the public API documents plain str, and this
+    # runs on every ask()/tell().
+    if type(request) is str:
+        return ({'_data': {'type': request}}, True)
+    if '_data' not in request:
+        return ({'_data': request}, True)
+    return (request, False)
 
 
 kinds = frozenset(('request', 'response', 'event'))
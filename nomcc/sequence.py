@@ -13,33 +13,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+
 import nomcc.exceptions
+import nomcc.message
 
 DEFAULT_BATCHING = 20
 
 
 class Reader(object):
     def __init__(self, session, data, timeout, num, raise_error):
-        if isinstance(data, str):
-            self.request = {'_data': {'type': data}}
-        else:
-            self.request = {'_data': data}
+        (self.request, _) = nomcc.message._normalize_request(data)
         self.session = session
         self.first = True
         self.done = False
-        self._datas = []
+        self._datas = collections.deque()
         self.timeout = timeout
         self._num = num
         self.raise_error = raise_error
         self._seq = None
         self.batch = False
+        # The 'next' request sent for every batch after the first.
+        # tell() does not return until the request has been written,
+        # so the same dicts can be reused across round-trips.
+        self._next_request = {'_ctrl': {}, '_data': {'type': 'next'}}
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if len(self._datas) > 0:
-            return self._datas.pop()
+        if self._datas:
+            return self._datas.popleft()
         elif self.done:
             raise StopIteration
         elif self.first:
@@ -56,11 +60,14 @@ class Reader(object):
             else:
                 self.done = True
             _data = response['_data']
+            if self.done and len(_data) == 1:
+                raise StopIteration
         else:
-            request = {'_ctrl': {'_seq': self._seq},
-                       '_data': {'type': 'next'}}
+            request = self._next_request
+            _ctrl = request['_ctrl']
+            _ctrl['_seq'] = self._seq
             if self.batch:
-                request['_ctrl']['_num'] = self._num
+                _ctrl['_num'] = self._num
             response = self.session.tell(request, self.timeout, False, True)
             if '_more' not in response['_ctrl']:
                 self.done = True
@@ -68,25 +75,40 @@ class Reader(object):
                 l = response['_data']['list']
                 if not isinstance(l, list):
                     raise nomcc.exceptions.BadSequence
-                self._datas = l
-                self._datas.reverse()
-                if len(self._datas) == 0:
+                if not l:
                     raise StopIteration
-                _data = self._datas.pop()
+                # A deque consumed with popleft() keeps the batch in
+                # arrival order without the O(n) reverse() that
+                # pop-from-the-end ordering needed.
+                self._datas = collections.deque(l)
+                _data = self._datas.popleft()
             else:
                 _data = response['_data']
-        if self.done and len(_data) == 1:
-            raise StopIteration
+                # A bare final response (just its 'type') carries no
+                # data; the check runs once per response, not once per
+                # batched row.
+                if self.done and len(_data) == 1:
+                    raise StopIteration
         if self.raise_error and 'err' in _data:
             raise nomcc.exceptions.Error(_data['err'])
         return _data
 
     next = __next__
 
+    # The _data section of the end-of-sequence request; tell() does not
+    # mutate it, so one shared instance suffices.
+    _NEXT_DATA = {'type': 'next'}
+
     def close(self):
-        if not self.done:
-            self.done = True
-            if not self.first:
-                request = {'_ctrl': {'_seq': self._seq, '_end': '1'},
-                           '_data': {'type': 'next'}}
-            response = self.session.tell(request, self.timeout)
+        if self.done:
+            return
+        self.done = True
+        if self.first:
+            # Nothing was ever sent, so there is no server-side
+            # sequence to end.  (This previously referenced an unbound
+            # 'request' and crashed.)
+            return
+        request = {'_ctrl': {'_seq': self._seq,
+                             '_end': nomcc.message._TRUE},
+                   '_data': self._NEXT_DATA}
+        self.session.tell(request, self.timeout)
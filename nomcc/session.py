@@ -15,6 +15,9 @@
 
 """Nominum Command Channel Sessions"""
 
+import concurrent.futures
+import itertools
+import queue
 import socket
 import sys
 import threading
@@ -36,8 +39,8 @@ class RequestState(object):
     The 'request' field is the request that was sent.
 
     The 'response' field is the response received, but is not valid
-    until 'done' is set.  Typically you call get_response() instead of
-    reading 'response' directly.
+    until the request has completed.  Typically you call
+    get_response() instead of reading 'response' directly.
     """
     def __init__(self, session, request, return_data, raise_error,
                  sequence_ok):
@@ -49,29 +52,36 @@ class RequestState(object):
         If 'raise_error' is true, then get_response() will raise a
         nomcc.exceptions.Error exception if the response has an 'err' field.
         """
-        self.done = threading.Event()
+        # A Future is a single lock+condition tuned for the
+        # complete-once pattern, where an Event is a condition
+        # wrapping a second lock.
+        self._future = concurrent.futures.Future()
         self.request = request
         self.return_data = return_data
         self.raise_error = raise_error
         self.sequence_ok = sequence_ok
         self.response = None
-        self.exception = None
 
     def wait(self, timeout=nomcc.closer.DEFAULT_TIMEOUT):
         """Wait for the request to complete, or the specified timeout
         to occur.
         """
-        self.done.wait(timeout)
+        try:
+            # exception() waits like result() but doesn't raise what
+            # return_exception() stored.
+            self._future.exception(timeout)
+        except concurrent.futures.TimeoutError:
+            pass
 
     def get_response(self, timeout=nomcc.closer.DEFAULT_TIMEOUT):
         """Get the response to the request.
 
         Waits until the request completes or the specified timeout occurs.
         """
-        if not self.done.wait(timeout):
+        try:
+            self.response = self._future.result(timeout)
+        except concurrent.futures.TimeoutError:
             raise nomcc.exceptions.Timeout
-        if self.exception is not None:
-            raise self.exception
         if not self.sequence_ok:
             _ctrl = self.response['_ctrl']
             if '_seq' in _ctrl:
@@ -80,7 +90,7 @@ class RequestState(object):
         if self.raise_error and 'err' in _data:
             raise nomcc.exceptions.Error(_data['err'])
         if self.return_data:
-            return self.response['_data']
+            return _data
         else:
             return self.response
 
@@ -89,12 +99,13 @@ class RequestState(object):
         waking up any waiters.
         """
         self.response = message
-        self.done.set()
+        if not self._future.done():
+            self._future.set_result(message)
         return True
 
     def return_exception(self, exception):
-        self.exception = exception
-        self.done.set()
+        if not self._future.done():
+            self._future.set_exception(exception)
 
 
 def _reader(session):
@@ -103,6 +114,7 @@ def _reader(session):
         while True:
             (message, state) = session.connection.read()
             session.not_idle()
+            tag = nomcc.message.classify(message)
             handled = False
             # try to handle the message ...
             try:
@@ -116,14 +128,14 @@ def _reader(session):
                 raise
             except Exception as e:
                 # ... but turning most into error responses
-                if nomcc.message.is_request(message):
+                if tag == nomcc.message.REQUEST:
                     response = nomcc.message.error(message, str(e))
                     session.write(response)
                     handled = True
                 session.connection.trace("session reader thread",
                                          "handling error: %s" % str(e))
             if not handled:
-                if nomcc.message.is_request(message):
+                if tag == nomcc.message.REQUEST:
                     response = nomcc.message.error(message,
                                                    "unknown request")
                     session.write(response)
@@ -140,41 +152,62 @@ def _reader(session):
         session.request_close()
 
 
+_WRITER_BATCH = 64
+
+
 def _writer(session):
     """Writer thread."""
     try:
+        get = session.write_queue.get
+        get_nowait = session.write_queue.get_nowait
         while True:
-            with session.write_lock:
-                while len(session.write_queue) == 0:
-                    session.wake_writer.wait()
-                (message, state) = session.write_queue.pop(0)
+            # Block for the first message, then opportunistically drain
+            # a batch so the wakeup cost is amortized across it.
+            batch = [get()]
+            try:
+                while (len(batch) < _WRITER_BATCH and
+                       batch[-1][0] is not None):
+                    batch.append(get_nowait())
+            except queue.Empty:
+                pass
+            session.not_idle()
+            # Serialize the whole batch, then send it with a single
+            # scatter-gather call; socket errors from the send
+            # propagate to the outer handler, which shuts down.
+            exiting = False
+            buffers = []
+            for (message, state) in batch:
                 if message is None:
-                    # request to exit
+                    # request to exit, after flushing what preceded it
+                    exiting = True
                     break
-            session.not_idle()
-            try:
-                session.connection.write(message, state)
-            except (socket.error, socket.timeout):
-                # socket problems are not something we can continue from
-                # so reraise
-                raise
-            except Exception as e:
-                # Something went wrong in rendering, but nothing was sent,
-                # so the connection is still ok.  Try to inform the
-                # originator.
-                if state is not None:
-                    try:
-                        state.return_exception(e)
-                    except Exception:
-                        # We don't expect this path to happen very
-                        # often, so we just trace it for now as
-                        # opposed to trying to notify the session
-                        # about the bad message some other way.
-                        (ty, va) = sys.exc_info()[:2]
-                        session.connection.trace("session writer thread",
-                                                 "sending message threw " +
-                                                 "exception %s: %s" %
-                                                 (str(ty), str(va)))
+                try:
+                    wire = session.connection.render(message, state)
+                except Exception as e:
+                    # Something went wrong in rendering, but nothing
+                    # was sent, so the connection is still ok.  Try to
+                    # inform the originator.
+                    if state is not None:
+                        try:
+                            state.return_exception(e)
+                        except Exception:
+                            # We don't expect this path to happen very
+                            # often, so we just trace it for now as
+                            # opposed to trying to notify the session
+                            # about the bad message some other way.
+                            (ty, va) = sys.exc_info()[:2]
+                            session.connection.trace(
+                                "session writer thread",
+                                "sending message threw " +
+                                "exception %s: %s" %
+                                (str(ty), str(va)))
+                    continue
+                if wire is not None:
+                    buffers.append(wire)
+            if buffers:
+                session.connection.write_rendered(buffers)
+            if exiting:
+                return
     except Exception:
         (ty, va) = sys.exc_info()[:2]
         session.connection.trace("session writer thread",
@@ -206,14 +239,19 @@ class Session(nomcc.closer.ThreadedCloser):
         super(Session, self).__init__()
         self.connection = connection
         self.dispatch = dispatch
-        # sequence_loc covers sequences and next_id
+        # Sequence ids come from itertools.count, whose __next__ is
+        # atomic under the GIL, and single dict operations on
+        # 'sequences' are likewise atomic; sequence_lock only covers
+        # the insert against the shutdown transition in _close().
         self.sequence_lock = threading.Lock()
         self.sequences = {}
-        self.next_id = 1
-        # write_lock covers write_queue and wake_writer
+        self._next_id = itertools.count(1)
+        # SimpleQueue is unbounded with a C fast path, so write() needs
+        # no explicit condition signaling; write_lock only serializes
+        # puts against the write_closed check in _close().
         self.write_lock = threading.Lock()
-        self.write_queue = []
-        self.wake_writer = threading.Condition(self.write_lock)
+        self.write_queue = queue.SimpleQueue()
+        self.write_closed = False
         self.reader = threading.Thread(target=_reader, args=[self],
                                        name="cc-reader")
         self.reader.daemon = True
@@ -257,22 +295,22 @@ class Session(nomcc.closer.ThreadedCloser):
         outstanding = self.connection.take_outstanding()
         for state in outstanding.values():
             if state is not None:
-                state.exception = nomcc.exceptions.Closing()
-                state.done.set()
+                state.return_exception(nomcc.exceptions.Closing())
         with self.write_lock:
-            # Tell writer to exit.
-            self.write_queue.insert(0, (None, None))
-            self.wake_writer.notify()
-        self.writer.join()
-        with self.write_lock:
-            # take possession of the queue remnants
-            wq = self.write_queue
             # prevent further write attempts
-            self.write_queue = None
-        for (message, state) in wq:
+            self.write_closed = True
+        # Tell writer to exit.
+        self.write_queue.put((None, None))
+        self.writer.join()
+        # Cancel the queue remnants; no new entries can arrive now that
+        # write_closed is set.
+        while True:
+            try:
+                (message, state) = self.write_queue.get_nowait()
+            except queue.Empty:
+                break
             if state is not None:
-                state.exception = nomcc.exceptions.Closing()
-                state.done.set()
+                state.return_exception(nomcc.exceptions.Closing())
         # Take possession of sequences and close them
         with self.sequence_lock:
             sequences = self.sequences
@@ -289,11 +327,9 @@ class Session(nomcc.closer.ThreadedCloser):
         Clients should NOT need to call this method directly.
         """
         with self.write_lock:
-            if self.write_queue is None:
+            if self.write_closed:
                 raise nomcc.exceptions.Closing
-            self.write_queue.append((message, state))
-            if len(self.write_queue) == 1:
-                self.wake_writer.notify()
+            self.write_queue.put((message, state))
 
     def ask(self, request, raise_error=True, sequence_ok=False):
         """Send a request.
@@ -319,17 +355,7 @@ class Session(nomcc.closer.ThreadedCloser):
         the response.
 
         """
-        if isinstance(request, str):
-            request = {'_data': {'type': request}}
-            return_data = True
-        elif '_data' not in request:
-            # Request is not a full message; caller prefers to deal
-            # just with _data.  Wrap into a proper message, and
-            # remember to unwrap later.
-            request = {'_data': request}
-            return_data = True
-        else:
-            return_data = False
+        (request, return_data) = nomcc.message._normalize_request(request)
         rstate = RequestState(self, request, return_data, raise_error,
                               sequence_ok)
         self.write(request, rstate)
@@ -392,9 +418,10 @@ class Session(nomcc.closer.ThreadedCloser):
 
         Returns the sequence id.
         """
+        id = str(next(self._next_id))
         with self.sequence_lock:
-            id = str(self.next_id)
-            self.next_id += 1
+            if self.sequences is None:
+                raise nomcc.exceptions.Closing
             self.sequences[id] = sequence
         return id
 
@@ -404,15 +431,13 @@ class Session(nomcc.closer.ThreadedCloser):
         A KeyError exception will be raised if the specified sequence does
         not exist.
         """
-        with self.sequence_lock:
-            sequence = self.sequences[id]
-            del self.sequences[id]
+        # dict.pop is a single (GIL-atomic) operation.
+        sequence = self.sequences.pop(id)
         sequence.close()
 
     def get_sequence(self, id):
         """Get sequence object for the specified id."""
-        with self.sequence_lock:
-            return self.sequences.get(id)
+        return self.sequences.get(id)
 
     def getpeername(self):
         """Get the peername of the other half of the connection.
@@ -462,6 +487,11 @@ def connect(*args, **kwargs):
     a message string.  The method is invoked at various points of the
     during the connection and can be used for debugging.
 
+    'sndbuf' and 'rcvbuf' are the socket send and receive buffer sizes
+    to request, in octets.  The default is
+    nomcc.connection.DEFAULT_SOCKET_BUFSIZE; use None to keep the
+    operating system's defaults.
+
     Returns a Session object.
 
     """
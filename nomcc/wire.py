@@ -19,17 +19,26 @@ Encode and decode messages using the Nominum command channel format (V1).
 """
 
 import base64
+import functools
 import hmac
+import os
 import string
 import struct
 import hashlib
-import random
 
 import zlib
 
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
-from nomcc._compat import *
+try:
+    # libdeflate (the 'deflate' package) produces and consumes the
+    # same raw-deflate streams as zlib, typically about twice as fast.
+    # It is optional; zlib is the fallback.
+    import deflate as _libdeflate
+except ImportError:
+    _libdeflate = None
+
+from nomcc._compat import decode, maybe_decode, maybe_encode
 from nomcc.exceptions import BadVersion, BadAuth, UnexpectedEnd, BadSyntax, \
      BadForm, NeedSecret
 
@@ -45,29 +54,92 @@ cc_auth_fixed = (b'\x05\x5f\x61\x75\x74\x68\x02\x00' +
                  b'\x00\x00\x20\x04\x68\x6d\x64\x35' +
                  b'\x01\x00\x00\x00\x16')
 
+_U32 = struct.Struct('!I')
+_BI = struct.Struct('!BI')
+# Placeholder for a type + length header, back-patched once the value's
+# encoded length is known.
+_HDR5 = bytes(5)
+
 # cipher data block size in octets
 cc_aes256_blocksize = 16
 # Padding must be as long as blocksize
 cc_aes256_padding = b'\xde\xad\xbe\xef' * 4
 
 
+# Module-level constructor aliases.  _sha256 skips the hashlib
+# attribute lookup per call; _md5 passes usedforsecurity=False where
+# the interpreter supports it (3.9+), which skips FIPS gatekeeping on
+# builds that have it -- the keyed HMAC construction, not bare MD5, is
+# what authenticates messages.
+_sha256 = hashlib.sha256
+
+try:
+    hashlib.md5(b'', usedforsecurity=False)
+
+    def _md5(data=b''):
+        return hashlib.md5(data, usedforsecurity=False)
+except TypeError:
+    _md5 = hashlib.md5
+
+
+@functools.lru_cache(maxsize=64)
+def _key_from_secret_bytes(secret):
+    return _sha256(secret).digest()
+
+
 def _key_from_secret(secret):
     """Convert an arbitrary string into a 32 octet key appropriate for
     use in encrypting a message.
+
+    A connection derives the same key for every message, so the SHA-256
+    is memoized on the encoded secret.
+    """
+    return _key_from_secret_bytes(maybe_encode(secret))
+
+
+@functools.lru_cache(maxsize=64)
+def _hmac_md5_pads(key):
+    """Return MD5 contexts preloaded with the HMAC ipad and opad blocks
+    for 'key'.
+
+    The XORed key blocks are constant per key, so the per-message work
+    reduces to copy() of each context (RFC 2104 key setup done once).
     """
-    m = hashlib.sha256()
-    m.update(maybe_encode(secret))
-    return m.digest()
+    if len(key) > 64:
+        key = _md5(key).digest()
+    key = key.ljust(64, b'\0')
+    inner = _md5(bytes(b ^ 0x36 for b in key))
+    outer = _md5(bytes(b ^ 0x5C for b in key))
+    return (inner, outer)
+
+
+def _hmac_md5(key, fragments):
+    """HMAC-MD5 of the concatenation of 'fragments' under 'key', using
+    the cached pad states."""
+    (inner, outer) = _hmac_md5_pads(key)
+    inner = inner.copy()
+    for fragment in fragments:
+        inner.update(fragment)
+    outer = outer.copy()
+    outer.update(inner.digest())
+    return outer.digest()
 
 
 def _encrypt_message(key, message):
-    # Generate a random IV
-    iv = [random.randint(0, 0xff) for x in range(cc_aes256_blocksize)]
-    iv = struct.pack('%dB' % len(iv), *iv)
-    # Pad message to AES blocksize
+    # Generate a random IV straight from the kernel RNG; one call for
+    # all 16 octets, and cryptographically strong unlike the random
+    # module.
+    iv = os.urandom(cc_aes256_blocksize)
+    # Pad message to AES blocksize.  A right-sized bytearray costs one
+    # allocation and one copy; += on bytes would build the pad object
+    # and recopy the whole message.  The cipher accepts any
+    # buffer-protocol object.
     msglen = len(message)
-    padlen = ((msglen + 0xF) & ~0xF) - msglen
-    message += b'\0' * padlen
+    padlen = -msglen & 0xF
+    if padlen:
+        padded = bytearray(msglen + padlen)
+        padded[:msglen] = message
+        message = padded
     # Encrypt
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
     encryptor = cipher.encryptor()
@@ -87,13 +159,20 @@ def _decrypt_message(key, message):
 
 
 def _compress_message(message):
+    if _libdeflate is not None:
+        return _libdeflate.deflate_compress(message, 6)
     compress = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
     return compress.compress(message) + compress.flush(zlib.Z_FINISH)
 
 
-def _decompress_message(message):
-    decompress = zlib.decompressobj(-15)
-    return decompress.decompress(message) + decompress.flush()
+def _decompress_message(message, out_size):
+    # The inner length prefix tells us the plaintext size exactly, so
+    # the output buffer can be allocated once instead of grown by
+    # doubling.  Trailing cipher padding after the deflate stream is
+    # ignored, as it was with decompressobj.
+    if _libdeflate is not None:
+        return _libdeflate.deflate_decompress(message, out_size)
+    return zlib.decompress(message, -15, out_size)
 
 
 def to_wire(message, secret=None):
@@ -107,77 +186,105 @@ def to_wire(message, secret=None):
     # See if we want compression.
     want_compress = message['_ctrl'].pop('_comp', None)
 
-    unsigned = _encode_table(message)
-    version = struct.pack('!I', cc_version)
+    version = _U32.pack(cc_version)
 
     if '_enc' in message['_ctrl']:
         if secret is None:
             raise NeedSecret
 
         # Since we're using a block cipher, the message may be padded,
-        # so we need to prefix it with its length.
+        # so we need to prefix it with its length.  Encode into a
+        # buffer with a 4 octet length slot up front, filled in after.
+        body = bytearray(4)
+        _encode_table_into(body, message)
+        _U32.pack_into(body, 0, len(body) - 4)
         if want_compress:
-            unsigned = struct.pack('!I', len(unsigned)) + \
-                    _compress_message(unsigned)
+            unsigned = body[:4] + _compress_message(memoryview(body)[4:])
             field_name = '_aes256z'
         else:
-            unsigned = struct.pack('!I', len(unsigned)) + unsigned
+            unsigned = body
             field_name = '_aes256'
 
         key = _key_from_secret(secret)
         payload = _encrypt_message(key, unsigned)
-        unsigned = _encode_table({field_name: payload})
+        out = _encode_table({field_name: payload})
+    else:
+        out = _encode_table(message)
 
     if secret is not None:
-        h = hmac.new(maybe_encode(secret), digestmod=hashlib.md5)
-        h.update(unsigned)
-        sig = base64.b64encode(h.digest())[:-2]              # strip '=='
-        res = version + _encode_table({'_auth': {'hmd5': sig}}) + unsigned
+        digest = _hmac_md5(maybe_encode(secret), (out,))
+        # A 16 octet digest is 22 base64 characters plus '==' padding.
+        sig = base64.b64encode(digest)[:22]
+        auth = _encode_table({'_auth': {'hmd5': sig}})
+        head = [_U32.pack(4 + len(auth) + len(out)), version, auth]
     else:
-        res = version + unsigned
-
-    l = len(res)
+        head = [_U32.pack(4 + len(out)), version]
+    head.append(out)
+    return b''.join(head)
 
-    return struct.pack('!I', l) + res
 
+# The encoders append into one shared bytearray, whose growth is
+# amortized like list.append, rather than allocating a header object
+# and a concatenation per value.  Container headers are written as
+# placeholders and back-patched once the nested content's length is
+# known, so nothing is encoded twice.
 
 def _encode_table(item):
-    s = b''
-    for k in item.keys():
-        l = len(k)
+    out = bytearray()
+    _encode_table_into(out, item)
+    return out
+
+
+def _encode_table_into(out, item):
+    for (k, v) in item.items():
+        kb = maybe_encode(k)
+        l = len(kb)
         assert(l < 256)
-        s += struct.pack('B', l) + maybe_encode(k) + _encode(item[k])
-    return (s)
-
-
-def _encode(item):
-    if isinstance(item, dict):
-        s = _encode_table(item)
-        l = len(s)
-        t = cc_vtype_table
-    elif isinstance(item, list) or isinstance(item, tuple):
-        s = b''.join(map(_encode, item))
-        l = len(s)
-        t = cc_vtype_list
+        out.append(l)
+        out += kb
+        _encode_into(out, v)
+
+
+def _encode_into(out, item):
+    # Branches ordered by frequency: scalar leaves dominate, so test
+    # for them before the container types.
+    if isinstance(item, bytes):
+        s = item
+    elif isinstance(item, str):
+        s = item.encode('utf8')
+    elif isinstance(item, dict):
+        hdr = len(out)
+        out += _HDR5
+        _encode_table_into(out, item)
+        _BI.pack_into(out, hdr, cc_vtype_table, len(out) - hdr - 5)
+        return
+    elif isinstance(item, (list, tuple)):
+        hdr = len(out)
+        out += _HDR5
+        for v in item:
+            _encode_into(out, v)
+        _BI.pack_into(out, hdr, cc_vtype_list, len(out) - hdr - 5)
+        return
     else:
-        if isinstance(item, bytes):
-            s = item
-        elif isinstance(item, string_types):
-            s = maybe_encode(item)
-        else:
-            s = maybe_encode(str(item))
-        l = len(s)
-        t = cc_vtype_binarydata
-    return struct.pack('!BI', t, l) + s
+        s = str(item).encode('utf8')
+    out += _BI.pack(cc_vtype_binarydata, len(s))
+    out += s
 
 
-def _decode_table(item, top_level=False, want_stringify=None):
+# The decoders walk a single buffer (normally a memoryview, whose
+# slices are zero-copy) with integer offsets, rather than re-slicing
+# the remaining payload for every field.  Each takes the window
+# [off, end) and _decode/_decode_list return the offset they consumed
+# up to.
+
+def _decode_table(buf, off, end, top_level=False, want_stringify=None):
     t = {}
-    while item != b'':
-        l = struct.unpack('B', item[:1])[0] + 1
-        if len(item) < l:
+    while off < end:
+        l = buf[off] + 1
+        key_end = off + l
+        if key_end > end:
             raise UnexpectedEnd('table too short')
-        key = decode(item[1:l])
+        key = decode(bytes(buf[off + 1:key_end]))
         if top_level and key == '_data' and want_stringify is None:
             # We don't already have a stringify setting, and this is
             # the top-level _data section, which we want stringified.
@@ -185,42 +292,42 @@ def _decode_table(item, top_level=False, want_stringify=None):
         else:
             # use whatever stringify setting we had
             sub_want_stringify = want_stringify
-        rest = item[l:]
-        (value, l) = _decode(rest, sub_want_stringify)
+        (value, off) = _decode(buf, key_end, end, sub_want_stringify)
         t[key] = value
-        item = rest[l:]
     return t
 
 
-def _decode_list(item, want_stringify=False):
+def _decode_list(buf, off, end, want_stringify=False):
     li = []
-    while item != b'':
-        (value, l) = _decode(item, want_stringify)
-        li.append(value)
-        item = item[l:]
+    append = li.append
+    while off < end:
+        (value, off) = _decode(buf, off, end, want_stringify)
+        append(value)
     return li
 
 
-def _decode(item, want_stringify=False):
-    if len(item) < 5:
+def _decode(buf, off, end, want_stringify=False):
+    if off + 5 > end:
         raise UnexpectedEnd('value header too short')
-    rest = item[5:]
-    (type, l) = struct.unpack("!BI", item[:5])
-    if len(rest) < l:
+    (type, l) = _BI.unpack_from(buf, off)
+    off += 5
+    value_end = off + l
+    if value_end > end:
         raise UnexpectedEnd('value data too short')
     if type == cc_vtype_binarydata:
-        value = rest[:l]
+        value = bytes(buf[off:value_end])
         if want_stringify:
             value = maybe_decode(value)
     elif type == cc_vtype_table:
         value = _decode_table(
-            rest[:l], top_level=False, want_stringify=want_stringify
+            buf, off, value_end, top_level=False,
+            want_stringify=want_stringify
         )
     elif type == cc_vtype_list:
-        value = _decode_list(rest[:l], want_stringify)
+        value = _decode_list(buf, off, value_end, want_stringify)
     else:
         raise BadForm('unknown value type')
-    return (value, l + 5)
+    return (value, value_end)
 
 
 def _basic_syntax_checks(message, maybe_encrypted):
@@ -265,11 +372,11 @@ def from_wire(message, secret=None):
 
     if len(message) < 4:
         raise UnexpectedEnd('message version too short')
-    version = struct.unpack('!I', message[:4])
+    version = _U32.unpack_from(message)
     if version[0] != cc_version:
         raise BadVersion('unknown version %u' % version[0])
-    rest = message[4:]
-    table = _decode_table(rest, top_level=True)
+    mv = memoryview(message)
+    table = _decode_table(mv, 4, len(message), top_level=True)
     _basic_syntax_checks(table, True)
     has_auth = '_auth' in table
 
@@ -278,15 +385,20 @@ def from_wire(message, secret=None):
             raise BadAuth('signature mismatch')
         if len(message) < 43:
             raise UnexpectedEnd('encrypted message too short')
-        auth = rest[:21]
-        msig = rest[21:43]
-        payload = rest[43:]
-        h = hmac.new(maybe_encode(secret), digestmod=hashlib.md5)
-        h.update(payload)
-        sig = base64.b64encode(h.digest())[:-2]    # strip '=='
-        if auth != cc_auth_fixed:
+        # Public framing, not secret material; startswith is a plain
+        # memcmp at the given offset, with no slice allocated.
+        if not message.startswith(cc_auth_fixed, 4):
             raise BadAuth('unknown auth mechanism')
-        if sig != msig:
+        digest = _hmac_md5(maybe_encode(secret), (mv[47:],))
+        # Decode the wire signature and compare the raw digests, rather
+        # than base64-encoding our digest for every verify.
+        try:
+            wire_digest = base64.b64decode(bytes(mv[25:47]) + b'==')
+        except ValueError:
+            raise BadAuth('signature mismatch')
+        if not hmac.compare_digest(digest, wire_digest):
+            # Constant-time compare; bytes != short-circuits on the
+            # first differing byte, leaking a timing signal.
             raise BadAuth('signature mismatch')
 
     _aes256z = table.get('_aes256z')
@@ -302,7 +414,7 @@ def from_wire(message, secret=None):
         else:
             encrypted_data = _aes256
             compressed = False
-        if not isinstance(encrypted_data, binary_type):
+        if not isinstance(encrypted_data, bytes):
             raise BadForm('encrypted input is not a string')
 
     if secret is None:
@@ -313,16 +425,18 @@ def from_wire(message, secret=None):
 
     key = _key_from_secret(secret)
     wire = _decrypt_message(key, encrypted_data)
-    (wirelen,) = struct.unpack('!I', wire[0:4])
+    (wirelen,) = _U32.unpack_from(wire)
 
     if compressed:
-        wire = _decompress_message(wire[4:])
+        wire = _decompress_message(memoryview(wire)[4:], wirelen)
+        start = 0
     else:
-        wire = wire[4:]
+        start = 4
 
-    if wirelen > len(wire):
+    if wirelen > len(wire) - start:
         raise UnexpectedEnd('inner message too short')
-    table = _decode_table(wire[0:wirelen], top_level=True)
+    table = _decode_table(memoryview(wire), start, start + wirelen,
+                          top_level=True)
     _basic_syntax_checks(table, False)
 
     _ctrl = table.get('_ctrl')
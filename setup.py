@@ -27,6 +27,7 @@ setup(
     author       = 'Akamai',
     url          = 'https://github.com/akamai/nomcc',
     install_requires = ['cryptography > 3.1'],
+    python_requires = '>=3.8',
     classifiers = [
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
@@ -35,18 +36,13 @@ setup(
         "Operating System :: POSIX",
         "Programming Language :: Python",
         "Topic :: Software Development :: Libraries :: Python Modules",
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
-        "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
         "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
     ],
     provides = ['nomcc'],
-    zip_safe    = True,
+    zip_safe    = False,
     )